@@ -242,13 +242,12 @@ class IIDDataset(VisionDataset):
         # Collect the scene list
         data['sample_ids'] = self.split_list
 
-        # Collect the features
+        # Collect the features, one list of paths per feature, indexed the same way as the sample ids
         self.module_logger.debug("Collecting features")
-        data['samples'] = Batch(default=Batch)
+        data['paths'] = Batch()
 
-        for sample_id in data['sample_ids']:
-            for feature in self.features_to_include:
-                data['samples'][sample_id][feature] = os.path.join(self.root, feature, sample_id)
+        for feature in self.features_to_include:
+            data['paths'][feature] = [os.path.join(self.root, feature, sample_id) for sample_id in data['sample_ids']]
 
         return data
 
@@ -268,7 +267,7 @@ class IIDDataset(VisionDataset):
 
         # Load the images
         for feature in self.features_to_include:
-            image_path = os.path.join(self.root, self.data["samples"][sample_id][feature])
+            image_path = os.path.join(self.root, self.data["paths"][feature][index])
             sample[feature] = load_linear_image(image_path)
 
         # Add the metadata
@@ -0,0 +1,179 @@
+"""
+Fused Monte Carlo integrator of the render layer.
+Falls back to plain PyTorch when Triton is not available or the inputs are not on the GPU.
+"""
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+PDF_MIN = 0.001
+
+
+if triton is not None:
+    @triton.jit
+    def _load(ptr, b, s, c, row, col, sb, ss, sc, sh, sw, mask, other):
+        offs = b * sb + s[:, None] * ss + c * sc + row[None, :] * sh + col[None, :] * sw
+        return tl.load(ptr + offs, mask=mask, other=other).to(tl.float32)
+
+    @triton.jit
+    def _integrator_kernel(
+            diff_ptr, spec_ptr, light_ptr, wo_z_ptr, pdf_ptr,
+            color_diff_ptr, color_spec_ptr, shading_ptr,
+            diff_sb, diff_ss, diff_sc, diff_sh, diff_sw,
+            spec_sb, spec_ss, spec_sc, spec_sh, spec_sw,
+            light_sb, light_ss, light_sc, light_sh, light_sw,
+            wo_z_sb, wo_z_ss, wo_z_sc, wo_z_sh, wo_z_sw,
+            pdf_sb, pdf_ss, pdf_sc, pdf_sh, pdf_sw,
+            spp, height, width,
+            PDF_MIN: tl.constexpr,
+            USE_SPECULAR: tl.constexpr,
+            BLOCK_SPP: tl.constexpr,
+            BLOCK_P: tl.constexpr):
+        pid_b = tl.program_id(0)
+        pid_p = tl.program_id(1)
+
+        num_pixels = height * width
+        offs_p = pid_p * BLOCK_P + tl.arange(0, BLOCK_P)
+        mask_p = offs_p < num_pixels
+        row = offs_p // width
+        col = offs_p % width
+
+        for c in range(0, 3):
+            acc_diff = tl.zeros([BLOCK_P], dtype=tl.float32)
+            acc_spec = tl.zeros([BLOCK_P], dtype=tl.float32)
+            acc_light = tl.zeros([BLOCK_P], dtype=tl.float32)
+            # Stream over the samples, accumulating in registers
+            for s0 in range(0, spp, BLOCK_SPP):
+                offs_s = s0 + tl.arange(0, BLOCK_SPP)
+                mask = (offs_s[:, None] < spp) & mask_p[None, :]
+                light = _load(light_ptr, pid_b, offs_s, c, row, col,
+                              light_sb, light_ss, light_sc, light_sh, light_sw, mask, 0.0)
+                ndl = _load(wo_z_ptr, pid_b, offs_s, c, row, col,
+                            wo_z_sb, wo_z_ss, wo_z_sc, wo_z_sh, wo_z_sw, mask, 0.0)
+                ndl = tl.maximum(ndl, 0.0)
+                pdf = _load(pdf_ptr, pid_b, offs_s, c, row, col,
+                            pdf_sb, pdf_ss, pdf_sc, pdf_sh, pdf_sw, mask, 1.0)
+                pdf = tl.maximum(pdf, PDF_MIN)
+                light = light * ndl / pdf
+                diff = _load(diff_ptr, pid_b, offs_s, c, row, col,
+                             diff_sb, diff_ss, diff_sc, diff_sh, diff_sw, mask, 0.0)
+                acc_diff += tl.sum(diff * light, axis=0)
+                if USE_SPECULAR:
+                    spec = _load(spec_ptr, pid_b, offs_s, c, row, col,
+                                 spec_sb, spec_ss, spec_sc, spec_sh, spec_sw, mask, 0.0)
+                    acc_spec += tl.sum(spec * light, axis=0)
+                acc_light += tl.sum(light, axis=0)
+
+            out_offs = pid_b * 3 * num_pixels + c * num_pixels + offs_p
+            tl.store(color_diff_ptr + out_offs, acc_diff / spp, mask=mask_p)
+            tl.store(color_spec_ptr + out_offs, acc_spec / spp, mask=mask_p)
+            tl.store(shading_ptr + out_offs, acc_light / spp, mask=mask_p)
+
+
+def _sum_to(grad: torch.Tensor, shape):
+    """
+    Reduce a broadcasted gradient back to the shape of the input
+    """
+    dims = [i for i, (g, s) in enumerate(zip(grad.shape, shape)) if s == 1 and g != 1]
+    return grad.sum(dim=dims, keepdim=True) if dims else grad
+
+
+class _FusedIntegrator(torch.autograd.Function):
+    BLOCK_P = 128
+    MAX_BLOCK_SPP = 16
+
+    @staticmethod
+    def forward(ctx, brdf_diff, brdf_spec, light, wo_z, pdf_emitter, use_specular):
+        bn, spp, _, row, col = light.shape
+        shape = (bn, spp, 3, row, col)
+
+        # Broadcast with zero strides, nothing is materialized
+        inputs = [t.expand(shape) for t in (brdf_diff, brdf_spec, light, wo_z, pdf_emitter)]
+        strides = [stride for t in inputs for stride in t.stride()]
+
+        colorDiffuse = torch.empty(bn, 3, row, col, device=light.device, dtype=light.dtype)
+        colorSpec = torch.empty_like(colorDiffuse)
+        shading = torch.empty_like(colorDiffuse)
+
+        grid = (bn, triton.cdiv(row * col, _FusedIntegrator.BLOCK_P))
+        _integrator_kernel[grid](*inputs, colorDiffuse, colorSpec, shading, *strides, spp, row, col,
+                                 PDF_MIN=PDF_MIN,
+                                 USE_SPECULAR=use_specular,
+                                 BLOCK_SPP=min(triton.next_power_of_2(spp), _FusedIntegrator.MAX_BLOCK_SPP),
+                                 BLOCK_P=_FusedIntegrator.BLOCK_P)
+
+        ctx.save_for_backward(brdf_diff, brdf_spec, light, wo_z, pdf_emitter)
+        ctx.use_specular = use_specular
+        return colorDiffuse, colorSpec, shading
+
+    @staticmethod
+    def backward(ctx, grad_diff, grad_spec, grad_shading):
+        brdf_diff, brdf_spec, light, wo_z, pdf_emitter = ctx.saved_tensors
+        spp = light.size(1)
+
+        needs_brdf_diff, needs_brdf_spec, needs_light, needs_wo_z, needs_pdf = ctx.needs_input_grad[:5]
+        needs_brdf_spec = needs_brdf_spec and ctx.use_specular
+        grad_brdf_diff = grad_brdf_spec = grad_light = grad_wo_z = grad_pdf = None
+
+        ndl = torch.clamp(wo_z, min=0)
+        pdf = torch.clamp(pdf_emitter, min=PDF_MIN)
+        grad_diff = grad_diff.unsqueeze(1) / spp
+        grad_spec = grad_spec.unsqueeze(1) / spp
+
+        # Only build the full size products some input needs, the materials are fixed when optimizing the light
+        if needs_brdf_diff or needs_brdf_spec or needs_pdf:
+            weighted_light = light * ndl / pdf
+            if needs_brdf_diff:
+                grad_brdf_diff = _sum_to(grad_diff * weighted_light, brdf_diff.shape)
+            if needs_brdf_spec:
+                grad_brdf_spec = _sum_to(grad_spec * weighted_light, brdf_spec.shape)
+
+        if needs_light or needs_wo_z or needs_pdf:
+            grad_weighted_light = grad_diff * brdf_diff + grad_shading.unsqueeze(1) / spp
+            if ctx.use_specular:
+                grad_weighted_light = grad_weighted_light + grad_spec * brdf_spec
+            if needs_light:
+                grad_light = _sum_to(grad_weighted_light * ndl / pdf, light.shape)
+            # Gradients of the clamps, same as torch.clamp
+            if needs_wo_z:
+                grad_wo_z = _sum_to(grad_weighted_light * light / pdf * (wo_z >= 0), wo_z.shape)
+            if needs_pdf:
+                grad_pdf = _sum_to(-grad_weighted_light * weighted_light / pdf * (pdf_emitter >= PDF_MIN),
+                                   pdf_emitter.shape)
+        return grad_brdf_diff, grad_brdf_spec, grad_light, grad_wo_z, grad_pdf, None
+
+
+@torch.jit.script
+def _integrate_torch(brdf_diff: torch.Tensor, brdf_spec: torch.Tensor, light: torch.Tensor, wo_z: torch.Tensor,
+                     pdf_emitter: torch.Tensor, use_specular: bool):
+    light = light * wo_z.clamp_min(0) / pdf_emitter.clamp_min(PDF_MIN)
+
+    colorDiffuse = torch.mean(brdf_diff * light, dim=1)
+    if use_specular:
+        colorSpec = torch.mean(brdf_spec * light, dim=1)
+    else:
+        colorSpec = torch.zeros_like(colorDiffuse)
+
+    shading = torch.mean(light, dim=1)
+    return colorDiffuse, colorSpec, shading
+
+
+def integrate(brdf_diff: torch.Tensor, brdf_spec: torch.Tensor, light: torch.Tensor, wo_z: torch.Tensor,
+              pdf_emitter: torch.Tensor, use_specular: bool = True):
+    """
+    Monte Carlo estimate of the rendering equation with emitter sampling.
+    The inputs are broadcast against each other, so the BRDF terms do not need to be expanded along the samples.
+    The cosine term and the emitter pdf are clamped here, fused with the integration.
+    :param: brdf_diff/brdf_spec (bn, spp or 1, 3, h, w)
+    :param: light (bn, spp, 3, h, w)
+    :param: wo_z: cosine of the light direction in the local frame (bn, spp, 1, h, w)
+    :param: pdf_emitter (bn, spp, 1, h, w)
+    :return: colorDiffuse, colorSpec, shading (bn, 3, h, w)
+    """
+    if triton is not None and light.is_cuda:
+        return _FusedIntegrator.apply(brdf_diff, brdf_spec, light, wo_z, pdf_emitter, use_specular)
+    return _integrate_torch(brdf_diff, brdf_spec, light, wo_z, pdf_emitter, use_specular)
@@ -312,7 +312,7 @@ class FusedSGGridPointLighting(nn.Module):
     def pdf_direction(self, vpos, direction):
         # (bn, spp, 3, h, w)
         dist_sqr = torch.sum(torch.square(self.position[None, :, :, None, None] - vpos), dim=2, keepdim=True)
-        self.nearest_dist_sqr = dist_sqr.permute(1,0,2,3,4).view(self.spp, -1).min(dim=1).values
+        self.nearest_dist_sqr = dist_sqr.permute(1,0,2,3,4).reshape(self.spp, -1).min(dim=1).values
         return dist_sqr
 
     def deparameterize(self):
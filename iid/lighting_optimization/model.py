@@ -140,8 +140,7 @@ class EmissiveLightingModel(LightningModule):
         normal = geometry.normal
         depth = geometry.depth
 
-        vpos = depth_to_vpos(torch.clamp(depth[0, 0], min=1e-6), self.fov, True)
-        vpos = vpos.unsqueeze_(0)
+        vpos = torch.stack([depth_to_vpos(d, self.fov, True) for d in torch.clamp(depth[:, 0], min=1e-6)])
 
         lighting_model.position_init(vpos, normal, image)
 
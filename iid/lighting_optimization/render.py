@@ -1,16 +1,17 @@
 """
 Adapted from https://github.com/jingsenzhu/IndoorInverseRendering/blob/main/lightnet/models/render/__init__.py
 """
+import functools
 import math
-import glm
 
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as functional
 
-from iid.lighting_optimization.brdf import pdf_ggx, eval_ggx, pdf_diffuse, eval_diffuse, pdf_disney, eval_disney
-from iid.lighting_optimization.ssrt import ssrt
+from iid.lighting_optimization.brdf import eval_ggx, eval_diffuse, eval_disney
+from iid.lighting_optimization.integrator_triton import integrate
+from iid.lighting_optimization.ssrt_triton import ssrt
 
 
 class IIR_SSRT_RenderLayer(nn.Module):
@@ -23,7 +24,9 @@ class IIR_SSRT_RenderLayer(nn.Module):
                  spp = 1,
                  double_sided=True,
                  use_ssrt=False,
-                 use_specular=False,):
+                 use_specular=False,
+                 mixed_precision=False,
+                 compile_brdf=False,):
         super().__init__()
         self.imHeight = imHeight
         self.imWidth = imWidth
@@ -31,33 +34,85 @@ class IIR_SSRT_RenderLayer(nn.Module):
         self.use_ssrt = use_ssrt
         self.use_specular = use_specular
         self.double_sided = double_sided
+        # Evaluate the BRDF in bfloat16 on CUDA, the integration stays in float32
+        self.mixed_precision = mixed_precision
 
         self.fov = fov/180.0 * np.pi
-        self.cameraPos = np.array(cameraPos, dtype=np.float32).reshape([1, 3, 1, 1])
+        self.cameraPos = torch.tensor(cameraPos, dtype=torch.float32).view(1, 3, 1, 1)
         self.xRange = 1 * np.tan(self.fov/2)
         self.yRange = float(imHeight) / float(imWidth) * self.xRange
-        x, y = np.meshgrid(np.linspace(-self.xRange, self.xRange, imWidth),
-                np.linspace(-self.yRange, self.yRange, imHeight ) )
-        y = np.flip(y, axis=0)
-        z = -np.ones( (imHeight, imWidth), dtype=np.float32)
+        x = torch.linspace(-self.xRange, self.xRange, imWidth)
+        y = torch.linspace(self.yRange, -self.yRange, imHeight)
+        y, x = torch.meshgrid(y, x, indexing='ij')
+        z = -torch.ones_like(x)
 
-        pCoord = np.stack([x, y, z]).astype(np.float32)
-        pCoord = pCoord[np.newaxis, :, :, :]
-        v = self.cameraPos - pCoord
-        v = v / np.sqrt(np.maximum(np.sum(v*v, axis=1), 1e-12)[:, np.newaxis, :, :] )
-        v = v.astype(dtype = np.float32)
+        pCoord = torch.stack([x, y, z]).unsqueeze(0)
+        v = functional.normalize(self.cameraPos - pCoord, dim=1, eps=1e-6)
 
-        v = torch.from_numpy(v)
-        pCoord = torch.from_numpy(pCoord)
+        # Perspective projection for SSRT, only the depth range changes between calls
+        self.aspect = self.imWidth / self.imHeight
+        self.fovy = 2 * math.atan(math.tan(self.fov / 2) / self.aspect)
+        proj_base = torch.zeros(4, 4)
+        proj_base[0, 0] = 1 / (self.aspect * math.tan(self.fovy / 2))
+        proj_base[1, 1] = 1 / math.tan(self.fovy / 2)
+        proj_base[2, 3] = -1
+
+        # Pixel coordinates of the SSRT ray origins
+        pix_Y, pix_X = torch.meshgrid(torch.arange(imHeight), torch.arange(imWidth), indexing='ij')  # (h, w)
 
         up = torch.Tensor([0,1,0])
         # assert(brdf_type in ["disney", "ggx"])
         self.brdf_type = brdf_type
+        # The BRDF type is fixed per layer, resolve it once
+        if brdf_type == "ggx":
+            self.eval_brdf = eval_brdf_ggx
+        elif brdf_type == "diffuse":
+            self.eval_brdf = eval_brdf_diffuse
+        else:
+            self.eval_brdf = eval_brdf_disney
+        if compile_brdf and hasattr(torch, "compile"):
+            self.eval_brdf = torch.compile(self.eval_brdf, dynamic=False)
         self.spp = spp
 
         self.register_buffer('v', v, persistent=False)
         self.register_buffer('pCoord', pCoord, persistent=False)
         self.register_buffer('up', up, persistent=False)
+        self.register_buffer('proj_base', proj_base, persistent=False)
+        self.register_buffer('pix_Y', pix_Y, persistent=False)
+        self.register_buffer('pix_X', pix_X, persistent=False)
+
+        # Side streams of the BRDF and light evaluation, created once per device on the first CUDA forward
+        self._streams = {}
+
+    def perspective(self, near, far):
+        """
+        Right-handed perspective projection with [-1, 1] clip depth, built on the device of the layer
+        Follows the (column-major) memory layout of glm.perspective, as used by the SSRT engine.
+        :param: near: scalar or tensor of shape (*)
+        :param: far: scalar
+        :return: proj (*, 4, 4)
+        """
+        near = torch.as_tensor(near, dtype=self.proj_base.dtype, device=self.proj_base.device)
+        proj = self.proj_base.repeat(*near.shape, 1, 1)
+        proj[..., 2, 2] = -(far + near) / (far - near)
+        proj[..., 3, 2] = -2 * far * near / (far - near)
+        return proj
+
+    def evaluate_brdf(self, albedo, rough, metal, wi, wo):
+        """
+        Evaluate the BRDF for the sampled emitter directions
+        Since we are using emitter sampling, the sampling pdf is 1,
+        so the BRDF values are used as they are and broadcast over the samples in the integrator.
+        :param: albedo, rough, metal (bn, c, h, w)
+        :param: wi (bn, 1, 3, h, w)
+        :param: wo (bn, spp, 3, h, w)
+        :return: diffuse (bn, 1, 3, h, w) and specular (bn, spp or 1, 3, h, w) BRDF values
+        """
+        if self.mixed_precision and albedo.is_cuda:
+            albedo, rough, metal, wi, wo = (t.to(torch.bfloat16) for t in (albedo, rough, metal, wi, wo))
+
+        eval_diff, eval_spec, mask = self.eval_brdf(albedo, rough, metal, wi, wo)
+        return eval_diff.float(), eval_spec.float()
 
     def forward(
             self,
@@ -75,7 +130,6 @@ class IIR_SSRT_RenderLayer(nn.Module):
             im, albedo, normal, rough, metal, vpos: (bn, c, h, w)
         """
         bn, _, row, col = albedo.shape
-        assert (bn == 1)  # Only support bn = 1
         assert (row == self.imHeight and col == self.imWidth), f"row: {row}, col: {col}, imHeight: {self.imHeight}, imWidth: {self.imWidth}"
         dev = albedo.device
 
@@ -89,21 +143,19 @@ class IIR_SSRT_RenderLayer(nn.Module):
         #############################################
 
         cx, cy, cz = create_frame(normal)
-        fx, fy, fz = torch.split(torch.cat([cx, cy, cz], dim=0).permute(1,0,2,3), 1, dim=0)
+        # frame[:, i, j] is the i-th world coordinate of the j-th local axis
+        frame = torch.stack([cx, cy, cz], dim=2)  # (bn, 3, 3, h, w)
 
         # ============ W_i - Direction to the camera =================
         wi_world = self.v
-        wi = (wi_world[:, 0:1, ...] * fx +
-              wi_world[:, 1:2, ...] * fy +
-              wi_world[:, 2:3, ...] * fz)
+        wi = torch.einsum('bihw,bijhw->bjhw', wi_world, frame)
         if self.double_sided:
-            wi[:, 2, ...] = torch.abs(wi[:, 2, ...])
+            wi = torch.stack([wi[:, 0, ...], wi[:, 1, ...], torch.abs(wi[:, 2, ...])], dim=1)
 
-        wi_mask = torch.where(wi[:, 2:3, ...] < 1e-6, torch.zeros_like(wi[:, 2:3, ...]),
-                              torch.ones_like(wi[:, 2:3, ...]))
+        wi_mask = (wi[:, 2:3, ...] >= 1e-6).to(wi.dtype)
 
         wi[:, 2, ...] = torch.clamp(wi[:, 2, ...], min=1e-3)
-        wi = functional.normalize(wi, dim=1, eps=1e-6)
+        wi = normalize(wi, dim=1, eps=1e-6)
         wi = wi.unsqueeze(1)  # (bn, 1, 3, h, w)
 
         # Clipping
@@ -113,9 +165,6 @@ class IIR_SSRT_RenderLayer(nn.Module):
         bottom = center_y + radius
         wi = wi[:, :, :, top:bottom, left:right]
         wi_mask = wi_mask[:, :, top:bottom, left:right]
-        cx = cx[:, :, top:bottom, left:right]
-        cy = cy[:, :, top:bottom, left:right]
-        cz = cz[:, :, top:bottom, left:right]
         albedo_clip = albedo[:, :, top:bottom, left:right]
         metal_clip = metal[:, :, top:bottom, left:right]
         rough_clip = rough[:, :, top:bottom, left:right]
@@ -125,11 +174,9 @@ class IIR_SSRT_RenderLayer(nn.Module):
 
         # ============ W_o - Direction to the light =================
         wo_emitter = lighting_model.sample_direction(vpos=vpos.unsqueeze(1), normal=normal.unsqueeze(1))
-        wo = (wo_emitter[:, :, 0:1, ...] * fx.unsqueeze(1) +
-              wo_emitter[:, :, 1:2, ...] * fy.unsqueeze(1) +
-              wo_emitter[:, :, 2:3, ...] * fz.unsqueeze(1))
+        wo = torch.einsum('bsihw,bijhw->bsjhw', wo_emitter, frame)
         if self.double_sided:
-            wo[:, :, 2, ...] = torch.abs(wo[:, :, 2, ...].clone())
+            wo = torch.stack([wo[:, :, 0, ...], wo[:, :, 1, ...], torch.abs(wo[:, :, 2, ...])], dim=2)
 
         # Convert to world space
         direction = wo_emitter
@@ -137,24 +184,6 @@ class IIR_SSRT_RenderLayer(nn.Module):
         direction = direction.permute(1, 0, 2, 3, 4)  # (spp, bn, h, w, 3)
         direction = direction.reshape(lighting_model.spp, -1, 3)
 
-        # W_o BRDF evaluation
-        if self.brdf_type == "ggx":
-            pdfs = pdf_ggx(albedo_clip, rough_clip, metal_clip, wi, wo).unsqueeze(2)
-            eval_diff, eval_spec, mask = eval_ggx(albedo_clip, rough_clip, metal_clip, wi, wo)
-        elif self.brdf_type == "diffuse":
-            pdfs = pdf_diffuse(wi, wo)
-            eval_diff, eval_spec, mask = eval_diffuse(albedo_clip, wi, wo)
-        else:
-            pdfs = pdf_disney(rough_clip, metal_clip, wi, wo).unsqueeze(2)
-            eval_diff, eval_spec, mask = eval_disney(albedo_clip, rough_clip, metal_clip, wi, wo)
-
-        # Since we are using emitter sampling, the sampling pdf is 1
-        pdfs_brdf = torch.ones_like(pdfs)
-        pdfs_brdf = torch.clamp(pdfs_brdf, min=0.001)
-
-        brdfDiffuse = eval_diff.expand([1, lighting_model.spp, 3, irow, icol]) / pdfs_brdf
-        brdfSpec = eval_spec.expand([1, lighting_model.spp, 3, irow, icol]) / pdfs_brdf
-        # del ndl, pdfs, eval_diff, eval_spec
         #############################################
         ########### Incident Sampling End ###########
         #############################################
@@ -167,44 +196,41 @@ class IIR_SSRT_RenderLayer(nn.Module):
             ssrt_spp = 1
             ssrt_direction = direction.reshape(-1, 3)
 
-            fovy = 2 * math.atan(math.tan(self.fov / 2) / (self.imWidth / self.imHeight))
-            depth = -vpos[0, ...].permute(1, 2, 0)  # (h, w, 3)
-            depth[:, :, :-1] = 0
-            dmin = torch.min(depth[:, :, -1])
-            dmax = torch.max(depth[:, :, -1])
-            depth /= dmax
-            proj = glm.perspective(fovy, self.imWidth / self.imHeight, (dmin.item() / dmax.item()), 1.0)
-            proj = torch.from_numpy(np.array(proj)).to(dev)
+            depth = -vpos.permute(0, 2, 3, 1)  # (bn, h, w, 3)
+            depth[..., :-1] = 0
+            dmin = torch.amin(depth[..., -1], dim=(1, 2))
+            dmax = torch.amax(depth[..., -1], dim=(1, 2))
+            depth /= dmax.view(bn, 1, 1, 1)
+            proj = self.perspective(dmin / dmax, 1.0)  # (bn, 4, 4)
 
             depth = -depth
-            depth = depth.view(-1, 3, 1)
-            pos4 = torch.cat([depth, torch.ones(col * row, 1, 1, device=dev)], dim=1)
-            pos4 = (proj.unsqueeze(0) @ pos4)[:, :, 0]
+            depth = depth.reshape(bn, -1, 3, 1)
+            pos4 = torch.cat([depth, torch.ones(bn, col * row, 1, 1, device=dev)], dim=2)
+            pos4 = (proj.unsqueeze(1) @ pos4)[..., 0]
             # TODO: Debug this
-            # pos4 = pos4 / pos4[:, -1:]
-            depth = (pos4[:, :-1].view(row, col, 3) + 1) * 0.5
+            # pos4 = pos4 / pos4[..., -1:]
+            depth = (pos4[..., :-1].view(bn, row, col, 3) + 1) * 0.5
 
-            depth = depth[:, :, -1].unsqueeze(0).unsqueeze(0)  # (1, 1, h, w)
-            depth[torch.where(torch.isinf(depth))] = 1
-            depth_start = depth.expand(1, ssrt_spp, row, col)
+            depth = depth[..., -1].unsqueeze(1)  # (bn, 1, h, w)
+            depth = depth.masked_fill(torch.isinf(depth), 1)
+            depth_start = depth.expand(bn, ssrt_spp, row, col)
             depth_start = depth_start[:, :, top:bottom, left:right].flatten()
-            Y = torch.arange(0, row, device=dev)
-            X = torch.arange(0, col, device=dev)
-            Y, X = torch.meshgrid(Y, X)  # (h, w)
-            Y = Y[top:bottom, left:right]
-            X = X[top:bottom, left:right]
-            Y = Y.unsqueeze(0).expand(ssrt_spp, irow, icol).flatten()
-            X = X.unsqueeze(0).expand(ssrt_spp, irow, icol).flatten()
+            Y = self.pix_Y[top:bottom, left:right]
+            X = self.pix_X[top:bottom, left:right]
+            # ssrt() marches x and y in place, so they must not alias the cached grid
+            Y = Y.expand(bn, ssrt_spp, irow, icol).flatten().clone()
+            X = X.expand(bn, ssrt_spp, irow, icol).flatten().clone()
             N = ssrt_direction.size(0)
-            indices = torch.zeros(N, dtype=torch.long, device=dev)
+            indices = torch.arange(bn, device=dev).repeat_interleave(N // bn)
 
             ssrt_uv, mask, dz = ssrt(depth, normal, indices, proj, X, Y, ssrt_direction, depth_start)
 
-            ssrt_uv[~mask, ...] = -1
+            # masked_fill instead of boolean indexing, which would synchronize with the host
+            ssrt_uv = ssrt_uv.masked_fill(~mask.unsqueeze(-1), -1)
             uncertainty = torch.tanh(10 * dz)
 
             ssrt_uv = ssrt_uv.flip(1)  # xy->ij: x = j, y = i
-            uncertainty[~mask, ...] = 1
+            uncertainty = uncertainty.masked_fill(~mask.unsqueeze(-1), 1)
             # ##############################
             # ########## SSRT End ##########
             # ##############################
@@ -213,13 +239,13 @@ class IIR_SSRT_RenderLayer(nn.Module):
             # ###### Integrator Start ######
             # ##############################
             vpos = vpos[:, :, top:bottom, left:right]
-            positions = vpos.unsqueeze(1).expand(1, self.spp, 3, irow, icol).permute(0, 1, 3, 4, 2).reshape(-1, 3)  # (bn*spp*h*w, 3)
+            positions = vpos.unsqueeze(1).expand(bn, self.spp, 3, irow, icol).permute(0, 1, 3, 4, 2).reshape(-1, 3)  # (bn*spp*h*w, 3)
             u = ssrt_uv[:, 0]
             v = ssrt_uv[:, 1]
             normals = normal[indices, :, u, v]
             roughs = rough[indices, :, u, v]
             Kd = albedo * (1 - metal)
-            Ks = torch.lerp(torch.empty_like(albedo).fill_(0.04), albedo, metal)
+            Ks = 0.04 + metal * (albedo - 0.04)  # lerp(0.04, albedo, metal)
             Kd = Kd[indices, :, u, v]
             Ks = Ks[indices, :, u, v]
             model_kwargs = {
@@ -229,26 +255,35 @@ class IIR_SSRT_RenderLayer(nn.Module):
                 'Kd': Kd, 'Ks': Ks, 'rough': roughs
             }
 
-        light = lighting_model(direction=direction)
+        # W_o BRDF evaluation and light evaluation are independent, overlap them on separate streams
+        if dev.type == "cuda":
+            main_stream = torch.cuda.current_stream(dev)
+            if dev not in self._streams:
+                self._streams[dev] = (torch.cuda.Stream(dev), torch.cuda.Stream(dev))
+            brdf_stream, light_stream = self._streams[dev]
+            brdf_stream.wait_stream(main_stream)
+            light_stream.wait_stream(main_stream)
+            with torch.cuda.stream(brdf_stream):
+                brdfDiffuse, brdfSpec = self.evaluate_brdf(albedo_clip, rough_clip, metal_clip, wi, wo)
+            with torch.cuda.stream(light_stream):
+                light = lighting_model(direction=direction)
+            main_stream.wait_stream(brdf_stream)
+            main_stream.wait_stream(light_stream)
+            # Outputs allocated on the side streams are used and freed on the main stream
+            for t in (brdfDiffuse, brdfSpec, light):
+                t.record_stream(main_stream)
+        else:
+            brdfDiffuse, brdfSpec = self.evaluate_brdf(albedo_clip, rough_clip, metal_clip, wi, wo)
+            light = lighting_model(direction=direction)
 
         pdf_emitter = lighting_model.pdf_direction(vpos=vpos.unsqueeze(1), direction=wo_emitter)
-        pdf_emitter = torch.clamp(pdf_emitter, min=0.001)
-        ndl = torch.clamp(wo[:, :, 2:, ...], min=0)
 
         # light = get_light_chunk(model, im, model_kwargs, direction.size(0), self.chunk)
-        light = light.view(1, lighting_model.spp, irow, icol, 3)
-        light = light.permute(0, 1, 4, 2, 3)  # (bn, spp, 3, h, w)
-
-        light = light * ndl / pdf_emitter
+        light = light.view(lighting_model.spp, bn, irow, icol, 3)
+        light = light.permute(1, 0, 4, 2, 3)  # (bn, spp, 3, h, w)
 
-        colorDiffuse = torch.mean(brdfDiffuse * light, dim=1)
-        if self.use_specular:
-            colorSpec = torch.mean(brdfSpec * light, dim=1)
-        else:
-            colorSpec = torch.zeros_like(colorDiffuse)
-
-        shading = light
-        shading = torch.mean(shading, dim=1)
+        colorDiffuse, colorSpec, shading = integrate(brdfDiffuse, brdfSpec, light, wo[:, :, 2:, ...], pdf_emitter,
+                                                     use_specular=self.use_specular)
         ##############################
         ####### Integrator End #######
         ##############################
@@ -256,35 +291,69 @@ class IIR_SSRT_RenderLayer(nn.Module):
         return colorDiffuse, colorSpec, wi_mask, shading
 
 
-def create_frame(n: torch.Tensor, eps:float = 1e-6):
+def eval_brdf_ggx(albedo, rough, metal, wi, wo):
+    return eval_ggx(albedo, rough, metal, wi, wo)
+
+
+def eval_brdf_diffuse(albedo, rough, metal, wi, wo):
+    return eval_diffuse(albedo, wi, wo)
+
+
+def eval_brdf_disney(albedo, rough, metal, wi, wo):
+    return eval_disney(albedo, rough, metal, wi, wo)
+
+
+@torch.jit.script
+def normalize(v: torch.Tensor, dim: int = 1, eps: float = 1e-12):
+    """
+    Same as functional.normalize (p=2), written with rsqrt so that it fuses with the neighbouring elementwise ops
+    """
+    return v * torch.rsqrt(torch.sum(v * v, dim=dim, keepdim=True).clamp_min(eps * eps))
+
+
+@torch.jit.script
+def create_frame(n: torch.Tensor, eps: float = 1e-6):
     """
     Generate orthonormal coordinate system based on surface normal
     [Duff et al. 17] Building An Orthonormal Basis, Revisited. JCGT. 2017.
+    Scripted, so that the elementwise chain is fused into a single kernel.
     :param: n (bn, 3, ...)
     """
-    z = functional.normalize(n, dim=1, eps=eps)
-    sgn = torch.where(z[:,2,...] >= 0, 1.0, -1.0)
-    a = -1.0 / (sgn + z[:,2,...])
-    b = z[:,0,...] * z[:,1,...] * a
-    x = torch.stack([1.0 + sgn * z[:,0,...] * z[:,0,...] * a, sgn * b, -sgn * z[:,0,...]], dim=1)
-    y = torch.stack([b, sgn + z[:,1,...] * z[:,1,...] * a, -z[:,1,...]], dim=1)
+    z = normalize(n, dim=1, eps=eps)
+    z0 = z[:, 0, ...]
+    z1 = z[:, 1, ...]
+    z2 = z[:, 2, ...]
+    # Branchless sign, with sgn(0) = 1
+    sgn = torch.sign(z2) + (z2 == 0).to(z.dtype)
+    a = -1.0 / (sgn + z2)
+    b = z0 * z1 * a
+    x = torch.stack([1.0 + sgn * z0 * z0 * a, sgn * b, -sgn * z0], dim=1)
+    y = torch.stack([b, sgn + z1 * z1 * a, -z1], dim=1)
     return x, y, z
 
 
-def depth_to_vpos(depth: torch.Tensor, fov, permute=False, normalize=True) -> torch.Tensor:
-    row, col = depth.shape
+@functools.lru_cache(maxsize=8)
+def _vpos_grid(row: int, col: int, fov, device: torch.device):
+    """
+    Pixel center coordinates on the image plane at unit depth, scaled by the field of view
+    The returned tensors are shared between calls, they must not be modified in place.
+    :return: X, Y (h, w)
+    """
     fovx = math.radians(fov)
     fovy = 2 * math.atan(math.tan(fovx / 2) / (col / row))
-    vpos = torch.zeros(row, col, 3, device=depth.device)
+    Y = 1 - (torch.arange(row, device=device) + 0.5) / row
+    Y = Y * 2 - 1
+    X = (torch.arange(col, device=device) + 0.5) / col
+    X = X * 2 - 1
+    Y, X = torch.meshgrid(Y, X, indexing='ij')
+    return X * math.tan(fovx / 2), Y * math.tan(fovy / 2)
+
+
+def depth_to_vpos(depth: torch.Tensor, fov, permute=False, normalize=True) -> torch.Tensor:
+    row, col = depth.shape
     if normalize:
         dmax = torch.max(depth)
         depth = depth / dmax
-    Y = 1 - (torch.arange(row, device=depth.device) + 0.5) / row
-    Y = Y * 2 - 1
-    X = (torch.arange(col, device=depth.device) + 0.5) / col
-    X = X * 2 - 1
-    Y, X = torch.meshgrid(Y, X)
-    vpos[:,:,0] = depth * X * math.tan(fovx / 2)
-    vpos[:,:,1] = depth * Y * math.tan(fovy / 2)
-    vpos[:,:,2] = -depth
+    X, Y = _vpos_grid(row, col, fov, depth.device)
+    vpos = torch.stack([depth * X, depth * Y, -depth], dim=-1)
     return vpos if not permute else vpos.permute(2,0,1)
@@ -8,20 +8,19 @@ import torch.nn as nn
 def transform(pos: torch.Tensor, mat: torch.Tensor):
     """
     pos: (bn, 3)
-    mat: (4, 4)
+    mat: (4, 4) or (bn, 4, 4)
     """
     pos4 = torch.cat([pos, torch.ones(pos.size(0), 1, device=pos.device)], dim=1).unsqueeze(-1)  # (bn, 4, 1)
-    pos4 = (mat.unsqueeze(0) @ pos4)[:, :, 0]  # (bn, 4)
+    pos4 = (mat @ pos4)[:, :, 0]  # (bn, 4)
     pos4 = pos4 / pos4[:, -1:]
     return pos4[:, :-1]  # (bn, 3)
 
 
-def any_within_screen(pos):
+def within_image(x: torch.Tensor, y: torch.Tensor, h, w):
     """
-    pos: (bn, 3)
+    x, y: (bn)
     """
-    return torch.any(
-        (pos[:, 0] >= 0) & (pos[:, 0] <= 1) & (pos[:, 1] >= 0) & (pos[:, 1] <= 1) & (pos[:, 2] > 0) & (pos[:, 2] < 1))
+    return (x >= 0) & (x < w) & (y >= 0) & (y < h)
 
 
 def march_next(cur_pos: torch.Tensor, ray_dir: torch.Tensor, cur_x: torch.Tensor, cur_y: torch.Tensor, h, w,
@@ -39,18 +38,26 @@ def march_next(cur_pos: torch.Tensor, ray_dir: torch.Tensor, cur_x: torch.Tensor
     return cur_pos + ray_dir * torch.min(step_ratio, dim=1, keepdim=True).values, dx, dy
 
 
-def ssrt(depth: torch.Tensor, normal: torch.Tensor, indices: torch.LongTensor, proj: torch.Tensor, x: torch.Tensor,
-         y: torch.Tensor, d: torch.Tensor, depth_start: torch.Tensor):
+def init_march(depth: torch.Tensor, indices: torch.LongTensor, proj: torch.Tensor, x: torch.Tensor, y: torch.Tensor,
+               d: torch.Tensor, depth_start: torch.Tensor):
     """
-    depth, normal: (sn, ch, h, w)
-    proj: (4, 4)
-    x, y: (bn)
+    Project the rays to screen space and take the first marching step
+    depth: (sn, ch, h, w)
+    indices: (bn), image of each ray
+    proj: (4, 4) or (sn, 4, 4)
+    x, y: (bn), advanced in place
     d: (bn, 3)
     depth_start: (bn)
+    :return: cur_pos, d_proj (bn, 3), cur_x, cur_y, step_x, step_y (bn)
     """
     unproj = torch.inverse(proj)
+    if proj.dim() == 3:
+        # Invert once per image, the matrices are only gathered per ray when the images differ
+        if proj.size(0) == 1:
+            proj, unproj = proj[0], unproj[0]
+        else:
+            proj, unproj = proj[indices], unproj[indices]
     h, w = depth.shape[2:]
-    bn = x.size(0)
     uv = torch.stack([(x + 0.5) / w, 1 - (y + 0.5) / h], dim=1)  # (bn, 2)
     uv = uv * 2 - 1
     depth_start = depth_start * 2 - 1
@@ -66,26 +73,45 @@ def ssrt(depth: torch.Tensor, normal: torch.Tensor, indices: torch.LongTensor, p
     cur_pos, dx, dy = march_next(cur_pos, d_proj, cur_x, cur_y, h, w, step_x, step_y)
     cur_x += dx
     cur_y += dy
+    return cur_pos, d_proj, cur_x, cur_y, step_x, step_y
+
+
+def ssrt(depth: torch.Tensor, normal: torch.Tensor, indices: torch.LongTensor, proj: torch.Tensor, x: torch.Tensor,
+         y: torch.Tensor, d: torch.Tensor, depth_start: torch.Tensor):
+    """
+    depth, normal: (sn, ch, h, w)
+    indices: (bn), image of each ray
+    proj: (4, 4) or (sn, 4, 4)
+    x, y: (bn)
+    d: (bn, 3)
+    depth_start: (bn)
+    """
+    h, w = depth.shape[2:]
+    bn = x.size(0)
+    cur_pos, d_proj, cur_x, cur_y, step_x, step_y = init_march(depth, indices, proj, x, y, d, depth_start)
     mask = torch.zeros_like(x).bool()  # (bn)
     results = torch.zeros(bn, 2, dtype=torch.long, device=x.device)  # (bn, 2)
     dz = torch.zeros(bn, 1, device=x.device)
-    while any_within_screen(cur_pos) and not torch.all(mask):
-        mask_within_screen = (cur_x >= 0) & (cur_x < w) & (cur_y >= 0) & (cur_y < h)
-        i_screen = indices[mask_within_screen]
-        x_screen = cur_x[mask_within_screen]
-        y_screen = cur_y[mask_within_screen]
+    # A ray is tested until it hits or leaves the image. x and y march monotonically, so it does not come back, and it
+    # crosses at most h + w cells. Rays past the far plane keep being tested, the farthest pixels start there.
+    active = within_image(cur_x, cur_y, h, w)
+    for _ in range(h + w):
+        if not torch.any(active):
+            break
+        i_screen = indices[active]
+        x_screen = cur_x[active]
+        y_screen = cur_y[active]
         z = depth[i_screen, 0, y_screen, x_screen]
-        pz = cur_pos[mask_within_screen, 2]
-        mask_step = (pz >= z) & (
-                    torch.sum(d[mask_within_screen] * normal[i_screen, :, y_screen, x_screen], dim=1) <= 0) & ~mask[
-            mask_within_screen]
-        mask[mask_within_screen] |= mask_step
-        results[mask_within_screen] = torch.where(mask_step.unsqueeze(-1), torch.stack([x_screen, y_screen], dim=-1),
-                                                  results[mask_within_screen])
-        dz[mask_within_screen] = torch.where(mask_step.unsqueeze(-1), (pz - z).unsqueeze(-1), dz[mask_within_screen])
+        pz = cur_pos[active, 2]
+        mask_step = (pz >= z) & (torch.sum(d[active] * normal[i_screen, :, y_screen, x_screen], dim=1) <= 0)
+        mask[active] = mask_step
+        results[active] = torch.where(mask_step.unsqueeze(-1), torch.stack([x_screen, y_screen], dim=-1),
+                                      results[active])
+        dz[active] = torch.where(mask_step.unsqueeze(-1), (pz - z).unsqueeze(-1), dz[active])
         cur_pos, dx, dy = march_next(cur_pos, d_proj, cur_x, cur_y, h, w, step_x, step_y)
         cur_x += dx
         cur_y += dy
+        active = ~mask & within_image(cur_x, cur_y, h, w)
 
     return results, mask, dz
 
@@ -0,0 +1,130 @@
+"""
+Screen space ray marching with one Triton program per block of rays.
+Falls back to the reference PyTorch implementation when Triton is not available or the inputs are not on the GPU.
+"""
+import torch
+
+from iid.lighting_optimization import ssrt as ssrt_torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+if triton is not None:
+    @triton.jit
+    def _ssrt_kernel(
+            depth_ptr, normal_ptr, indices_ptr, pos_ptr, d_proj_ptr, dir_ptr,
+            cur_x_ptr, cur_y_ptr, step_x_ptr, step_y_ptr,
+            uv_ptr, mask_ptr, dz_ptr,
+            depth_sn, depth_sh, depth_sw,
+            normal_sn, normal_sc, normal_sh, normal_sw,
+            num_rays, height, width, max_steps,
+            BLOCK: tl.constexpr):
+        pid = tl.program_id(0)
+        offs = pid * BLOCK + tl.arange(0, BLOCK)
+        valid = offs < num_rays
+
+        idx = tl.load(indices_ptr + offs, mask=valid, other=0)
+        px = tl.load(pos_ptr + offs * 3, mask=valid, other=-1.0)
+        py = tl.load(pos_ptr + offs * 3 + 1, mask=valid, other=-1.0)
+        pz = tl.load(pos_ptr + offs * 3 + 2, mask=valid, other=-1.0)
+        dpx = tl.load(d_proj_ptr + offs * 3, mask=valid, other=0.0)
+        dpy = tl.load(d_proj_ptr + offs * 3 + 1, mask=valid, other=0.0)
+        dpz = tl.load(d_proj_ptr + offs * 3 + 2, mask=valid, other=0.0)
+        dx = tl.load(dir_ptr + offs * 3, mask=valid, other=0.0)
+        dy = tl.load(dir_ptr + offs * 3 + 1, mask=valid, other=0.0)
+        dz = tl.load(dir_ptr + offs * 3 + 2, mask=valid, other=0.0)
+        cx = tl.load(cur_x_ptr + offs, mask=valid, other=0)
+        cy = tl.load(cur_y_ptr + offs, mask=valid, other=0)
+        sx = tl.load(step_x_ptr + offs, mask=valid, other=0)
+        sy = tl.load(step_y_ptr + offs, mask=valid, other=0)
+
+        hit = offs < 0
+        res_x = tl.zeros([BLOCK], dtype=cx.dtype)
+        res_y = tl.zeros([BLOCK], dtype=cy.dtype)
+        res_dz = tl.zeros([BLOCK], dtype=tl.float32)
+
+        active = valid & (cx >= 0) & (cx < width) & (cy >= 0) & (cy < height)
+        steps = tl.zeros([BLOCK], dtype=tl.int32)
+        num_active = tl.sum(active.to(tl.int32), axis=0)
+        while num_active > 0:
+            # Same termination as ssrt.ssrt(), a ray is tested until it hits or leaves the image
+            z = tl.load(depth_ptr + idx * depth_sn + cy * depth_sh + cx * depth_sw, mask=active, other=0.0)
+            normal_offs = idx * normal_sn + cy * normal_sh + cx * normal_sw
+            nx = tl.load(normal_ptr + normal_offs, mask=active, other=0.0)
+            ny = tl.load(normal_ptr + normal_offs + normal_sc, mask=active, other=0.0)
+            nz = tl.load(normal_ptr + normal_offs + 2 * normal_sc, mask=active, other=0.0)
+
+            step_hit = active & (pz >= z) & (dx * nx + dy * ny + dz * nz <= 0)
+            res_x = tl.where(step_hit, cx, res_x)
+            res_y = tl.where(step_hit, cy, res_y)
+            res_dz = tl.where(step_hit, pz - z, res_dz)
+            hit = hit | step_hit
+            active = active & (step_hit == 0)
+
+            # March to the next cell boundary, same as march_next()
+            ratio_x = ((cx + sx).to(tl.float32) / width - px) / dpx
+            ratio_y = ((1 - (cy + sy).to(tl.float32) / height) - py) / dpy
+            ratio = tl.minimum(ratio_x, ratio_y)
+            step_in_y = ratio_x > ratio_y
+            px = tl.where(active, px + dpx * ratio, px)
+            py = tl.where(active, py + dpy * ratio, py)
+            pz = tl.where(active, pz + dpz * ratio, pz)
+            cx = tl.where(active & (step_in_y == 0), cx + sx, cx)
+            cy = tl.where(active & step_in_y, cy + sy, cy)
+
+            steps += 1
+            active = active & (cx >= 0) & (cx < width) & (cy >= 0) & (cy < height) & (steps < max_steps)
+            num_active = tl.sum(active.to(tl.int32), axis=0)
+
+        tl.store(uv_ptr + offs * 2, res_x, mask=valid)
+        tl.store(uv_ptr + offs * 2 + 1, res_y, mask=valid)
+        tl.store(mask_ptr + offs, hit.to(tl.int8), mask=valid)
+        tl.store(dz_ptr + offs, res_dz, mask=valid)
+
+
+BLOCK_RAYS = 128
+
+
+@torch.no_grad()
+def _ssrt_triton(depth: torch.Tensor, normal: torch.Tensor, indices: torch.LongTensor, proj: torch.Tensor,
+                 x: torch.Tensor, y: torch.Tensor, d: torch.Tensor, depth_start: torch.Tensor):
+    h, w = depth.shape[2:]
+    bn = x.size(0)
+    cur_pos, d_proj, cur_x, cur_y, step_x, step_y = ssrt_torch.init_march(depth, indices, proj, x, y, d, depth_start)
+
+    results = torch.zeros(bn, 2, dtype=cur_x.dtype, device=x.device)
+    mask = torch.zeros(bn, dtype=torch.int8, device=x.device)
+    dz = torch.zeros(bn, 1, device=x.device)
+
+    grid = (triton.cdiv(bn, BLOCK_RAYS),)
+    _ssrt_kernel[grid](depth, normal, indices.contiguous(), cur_pos.float().contiguous(),
+                       d_proj.float().contiguous(), d.float().contiguous(),
+                       cur_x.contiguous(), cur_y.contiguous(), step_x.contiguous(), step_y.contiguous(),
+                       results, mask, dz,
+                       depth.stride(0), depth.stride(2), depth.stride(3),
+                       *normal.stride(),
+                       bn, h, w, h + w,
+                       BLOCK=BLOCK_RAYS)
+    return results.long(), mask.bool(), dz
+
+
+def ssrt(depth: torch.Tensor, normal: torch.Tensor, indices: torch.LongTensor, proj: torch.Tensor, x: torch.Tensor,
+         y: torch.Tensor, d: torch.Tensor, depth_start: torch.Tensor):
+    """
+    Screen space ray tracing, see iid.lighting_optimization.ssrt.ssrt
+    Every ray terminates on its own, once it hits or leaves the image, same as the reference implementation.
+    The result is not differentiable.
+    depth, normal: (sn, ch, h, w)
+    indices: (bn), image of each ray
+    proj: (4, 4) or (sn, 4, 4)
+    x, y: (bn)
+    d: (bn, 3)
+    depth_start: (bn)
+    """
+    if triton is not None and depth.is_cuda:
+        return _ssrt_triton(depth, normal, indices, proj, x, y, d, depth_start)
+    return ssrt_torch.ssrt(depth, normal, indices, proj, x, y, d, depth_start)
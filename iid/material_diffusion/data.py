@@ -1,5 +1,4 @@
-import os
-
+import pandas as pd
 import torch
 from batch import Batch
 
@@ -15,62 +14,51 @@ class InteriorVerseDataset(IIDDataset):
     def load_dataset(self, allow_missing_features=False):
         # Collect the data
         data = Batch()
-        data['samples'] = Batch(default=Batch)
-        data['sample_ids'] = []
 
         self.module_logger.debug("Collecting features")
 
-        for line in self.split_list:
-            line = line.strip()
-            if not line:
-                continue
-
-            paths = line.split()
-            first_path = paths[0]
-
-            if self.stage.name == "Test" or self.stage.name == "Validation":
-                parts = first_path.split('/')
-                filename = parts[-1]
-                view_id = filename.split('.')[0]
-                scene_folder = '/'.join(parts[:-1])
-                sample_id = os.path.join(scene_folder, view_id)
+        is_eval = self.stage.name == "Test" or self.stage.name == "Validation"
+        # The evaluation splits come without masks
+        features = [feature for feature in self.features_to_include if not (is_eval and feature == "mask")]
+
+        # Parse all the split lines at once, only the first path of each line is used
+        lines = pd.Series(self.split_list, dtype=str).str.strip()
+        lines = lines[lines != ""]
+        if lines.empty:
+            data['sample_ids'] = []
+            data['paths'] = Batch(**{feature: [] for feature in features})
+            return data
+
+        parts = lines.str.split(n=1).str[0].str.rpartition('/')
+        scene_folder, filename = parts[0], parts[2]
+        view_id = filename.str.split('.' if is_eval else '_', n=1).str[0]
+
+        samples = pd.DataFrame({"sample_id": _join_paths(scene_folder, view_id),
+                                "scene_folder": scene_folder,
+                                "view_id": view_id})
+        samples = samples.drop_duplicates("sample_id").reset_index(drop=True)
+
+        for feature in features:
+            if is_eval:
+                feature_filename = samples["view_id"] + (".png" if feature == "im" else ".exr")
             else:
-                parts = first_path.split('/')
-                filename = parts[-1]
-                view_id = filename.split('_')[0]
-                scene_folder = '/'.join(parts[:-1])
-                sample_id = os.path.join(scene_folder, view_id)
-
-            if sample_id not in data['samples']:
-                data['sample_ids'].append(sample_id)
-
-                if self.stage.name == "Test" or self.stage.name == "Validation":
-                    for feature in self.features_to_include:
-                        if feature == "mask":
-                            continue
-                        elif feature == "im":
-                            feature_filename = f"{view_id}.png"
-                        elif feature == "albedo":
-                            feature_filename = f"{view_id}.exr"
-                        feature_path = os.path.join(scene_folder, feature_filename)
-                        data['samples'][sample_id][feature] = feature_path
-
-                else:
-                    for feature in self.features_to_include:
-                        if feature == "mask":
-                            feature_filename = f"{view_id}_{feature}.png"
-                        else:
-                            feature_filename = f"{view_id}_{feature}.exr"
-                        feature_path = os.path.join(scene_folder, feature_filename)
-                        data['samples'][sample_id][feature] = feature_path
-
-        # Sanity check
-        lengths = [len(list(data['samples'][sample_id].keys())) for sample_id in data['samples'].keys()]
-        assert all([lengths[0] == l for l in lengths]), "Missing feature!"
+                feature_filename = samples["view_id"] + (f"_{feature}.png" if feature == "mask" else f"_{feature}.exr")
+            samples[feature] = _join_paths(samples["scene_folder"], feature_filename)
+
+        data['sample_ids'] = samples["sample_id"].tolist()
+        data['paths'] = Batch(**{feature: samples[feature].tolist() for feature in features})
 
         return data
 
 
+def _join_paths(folder: pd.Series, name: pd.Series) -> pd.Series:
+    """
+    Vectorized os.path.join for relative posix paths
+    """
+    separator = pd.Series("/", index=folder.index).where(~(folder.eq("") | folder.str.endswith("/")), "")
+    return folder + separator + name
+
+
 class SubsetSequentialSampler(torch.utils.data.Sampler):
     """
     Samples elements sequentially from a given list of indices, without replacement.
@@ -85,7 +73,7 @@ class SubsetSequentialSampler(torch.utils.data.Sampler):
         self.indices = indices
 
     def __iter__(self):
-        return (self.indices[i] for i in range(len(self.indices)))
+        return iter(self.indices)
 
     def __len__(self):
         return len(self.indices)